@@ -1,59 +1,656 @@
 #!/usr/bin/env python3
 import sys
 import os
-import git
 import time
+import json
+import errno
+import fcntl
+import atexit
+import argparse
+import functools
+import importlib.util
 import signal
+import queue
+import select
+import shlex
+import shutil
+import socket
 import logging
+import logging.handlers
+import threading
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+def lazy_import(name):
+    """
+    Import a module when one of its attributes is first used, not now.
+    
+    GitPython, pygit2 and watchfiles take ~100ms to import between them, which
+    `list` and `stop all` never need.
+    
+    Returns:
+        The module, or None if it isn't installed
+    """
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+git = lazy_import('git')
+# Optional: without it we simply rely on the polling loop
+watchfiles = lazy_import('watchfiles')
+# Optional: without it fetches go through the git command line
+pygit2 = lazy_import('pygit2')
+
+# Filesystems where inotify/FSEvents don't see changes made by other hosts
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afpfs', 'fuse.sshfs', '9p'}
+
+# Settings that speed up the revision walks and status scans the syncer triggers.
+# Only applied when the user hasn't configured them already.
+REPO_PERFORMANCE_CONFIG = {
+    'core.commitGraph': 'true',
+    'core.untrackedCache': 'true',
+}
+
+MIN_CHECK_INTERVAL = 5  # seconds between fetches while the branch is active
+MAX_CHECK_INTERVAL = 300  # cap once the branch has gone quiet
+IDLE_CHECKS_PER_BACKOFF = 12  # consecutive empty checks before doubling the interval
+
+DAEMON_STOP_TIMEOUT = 10  # seconds to wait for a daemon to exit after SIGTERM
+
+FETCH_BATCH_WINDOW = 0.1  # seconds to collect branches before running a shared fetch
+
+# Share one SSH connection to origin between the frequent ls-remote/fetch
+# calls. %C is a hash of the connection, which keeps the socket path short.
+SSH_CONTROL_DIR = Path.home() / ".gitbranchsyncer" / "ssh"
+SSH_CONTROL_PERSIST = "10m"
+
+# Per-repository command socket, kept in the repository's .git directory
+SOCKET_FILE_NAME = "branch-syncer.sock"
+SOCKET_LOCK_NAME = "branch-syncer.lock"  # Held while binding, so only one start claims the socket
+COMMAND_TIMEOUT = 5  # seconds a client gets to send its request
+COMMAND_REPLY_TIMEOUT = 30  # seconds to wait for the daemon to answer (it may be mid-sync)
+
+LOG_FILE = Path.home() / ".gitbranchsyncer" / "logs" / "gitbranchsyncer.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024  # rotate the log file at this size
+LOG_BACKUP_COUNT = 3  # rotated log files to keep
+
+# systemd user unit template; the instance name is the escaped repository path
+SYSTEMD_UNIT_TEMPLATE = "gitbranchsyncer@.service"
+
+# Every running syncer's PID, repository and branches
+REGISTRY_FILE = Path.home() / ".gitbranchsyncer" / "daemons.json"
+
+class RemoteBranchNotFound(Exception):
+    """The branch no longer exists on origin."""
+
+class FetchCoordinator:
+    """
+    Batches fetches for one repository into a single `git fetch`.
+    
+    Syncers post the remote branch they track and get back a future. Requests
+    that arrive within FETCH_BATCH_WINDOW of each other share one ls-remote
+    probe and at most one fetch (one process, one connection, one pack
+    negotiation), and only branches whose remote head moved are fetched.
+    With pygit2 installed both run in-process through libgit2, falling back
+    to the git command line if libgit2 can't reach the remote.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self._lock = threading.Lock()
+        self._pending = {}  # remote branch name -> futures waiting on it
+        self._refspecs = {}  # remote branch name -> refspec to fetch it with
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._use_pygit2 = pygit2 is not None
+        self._pygit2_repo = None  # Opened on the worker thread
+        self.share_ssh_connection()
+        
+    def share_ssh_connection(self):
+        """
+        Have git's ssh reuse one connection to origin (OpenSSH ControlMaster).
+        
+        Skipped if the user already chose an ssh command, so their settings win.
+        """
+        if any(var in os.environ for var in ('GIT_SSH_COMMAND', 'GIT_SSH')):
+            return
+        if self.repo.config_reader().has_option('core', 'sshCommand'):
+            return
+        SSH_CONTROL_DIR.mkdir(parents=True, exist_ok=True, mode=0o700)
+        control_path = shlex.quote(str(SSH_CONTROL_DIR / "%C"))
+        self.repo.git.update_environment(
+            GIT_SSH_COMMAND=f"ssh -o ControlMaster=auto -o ControlPath={control_path} "
+                            f"-o ControlPersist={SSH_CONTROL_PERSIST}")
+        
+    def pygit2_remote(self):
+        """Return origin as a pygit2 Remote, or None to use the git command line."""
+        if not self._use_pygit2:
+            return None
+        try:
+            if self._pygit2_repo is None:
+                self._pygit2_repo = pygit2.Repository(self.repo.git_dir)
+            # A Remote keeps the first ref advertisement it sees, so get a fresh one each time
+            return self._pygit2_repo.remotes['origin']
+        except Exception as e:  # Not just GitError: e.g. KeyError if there's no origin
+            self.fall_back_to_git(e)
+            return None
+        
+    def fall_back_to_git(self, error):
+        """
+        Stop using libgit2 for this repository after it fails (e.g. unsupported
+        credentials), so a libgit2 problem never costs us the branches.
+        """
+        logging.getLogger('GitBranchSyncer').warning(f"libgit2 fetch failed, using git instead: {error}")
+        self._use_pygit2 = False
+        self._pygit2_repo = None
+        
+    def fetch(self, branch_name, refspec):
+        """Queue a fetch of origin/<branch_name> using refspec, returning a Future."""
+        future = Future()
+        with self._lock:
+            start_batch = not self._pending
+            self._pending.setdefault(branch_name, []).append(future)
+            self._refspecs[branch_name] = refspec
+        if start_batch:
+            self._executor.submit(self._fetch_batch)
+        return future
+        
+    def remote_heads(self, branch_names):
+        """Return {branch name: sha} for the given branches on origin."""
+        remote = self.pygit2_remote()
+        if remote is not None:
+            wanted = {f'refs/heads/{name}' for name in branch_names}
+            try:
+                return {head.name[len('refs/heads/'):]: str(head.oid)
+                        for head in remote.list_heads(callbacks=pygit2.RemoteCallbacks(pygit2_credentials))
+                        if head.name in wanted}
+            except Exception as e:  # Including API differences in older pygit2 releases
+                self.fall_back_to_git(e)
+                
+        output = self.repo.git.ls_remote('--heads', 'origin', *(f'refs/heads/{name}' for name in branch_names))
+        heads = {}
+        for line in output.splitlines():
+            sha, ref = line.split('\t', 1)
+            heads[ref[len('refs/heads/'):]] = sha
+        return heads
+        
+    def tracking_sha(self, branch_name):
+        """Return the sha of refs/remotes/origin/<branch_name>, or None if it doesn't exist."""
+        return ref_sha(self.repo, f'refs/remotes/origin/{branch_name}')
+        
+    def _fetch_batch(self):
+        """Wait for the batching window, then fetch every queued branch that changed."""
+        time.sleep(FETCH_BATCH_WINDOW)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            
+        try:
+            # ls-remote is one round trip with no pack negotiation, and nearly
+            # every check finds nothing new
+            remote_heads = self.remote_heads(pending)
+        except Exception as e:
+            self._resolve(pending, error=e)
+            return
+            
+        stale = {name: pending.pop(name) for name in list(pending)
+                 if name in remote_heads and remote_heads[name] != self.tracking_sha(name)}
+                 
+        # Release everything that doesn't need the fetch right away so callers
+        # can check those branches while it runs. Leave branches deleted on the
+        # remote out of the fetch so they don't fail it for everyone else.
+        for name, futures in pending.items():
+            if name in remote_heads:
+                self._resolve({name: futures})
+            else:
+                self._resolve({name: futures}, error=RemoteBranchNotFound(name))
+                
+        if not stale:
+            return
+        try:
+            self.fetch_refspecs([self._refspecs[name] for name in stale])
+        except Exception as e:
+            self._resolve(stale, error=e)
+        else:
+            self._resolve(stale)
+            
+    def fetch_refspecs(self, refspecs):
+        """Fetch refspecs from origin, in-process when pygit2 is available."""
+        remote = self.pygit2_remote()
+        if remote is not None:
+            try:
+                remote.fetch(refspecs, callbacks=pygit2.RemoteCallbacks(pygit2_credentials),
+                             prune=pygit2.enums.FetchPrune.NO_PRUNE)
+                return
+            except Exception as e:  # Including API differences in older pygit2 releases
+                self.fall_back_to_git(e)
+                
+        # Only the monitored branches: no tags, and no pruning of the
+        # remote-tracking refs we didn't ask for
+        self.repo.git.fetch('--no-tags', '--no-prune', 'origin', *refspecs)
+        
+    def _resolve(self, pending, error=None):
+        """Complete every future in pending ({branch name: futures}), failing them with error if given."""
+        for futures in pending.values():
+            for future in futures:
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A RotatingFileHandler that every syncer process can share.
+    
+    Writes and rollovers happen under an flock on a lock file next to the log,
+    and a process whose file was rotated away by another reopens it, so each
+    size check sees the real file and no lines end up in a rotated backup.
+    """
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self._lock_file = open(f"{self.baseFilename}.lock", 'a')
+        
+    def emit(self, record):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            if self.stream is not None and get_inode(Path(self.baseFilename)) != os.fstat(self.stream.fileno()).st_ino:
+                self.stream.close()
+                self.stream = None  # Reopened on write
+            super().emit(record)
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            
+    def close(self):
+        super().close()
+        self._lock_file.close()
+
+_log_listener = None
+
+def configure_logging(daemon_mode=False):
+    """
+    Set up logging for the process, once.
+    
+    Log calls only put records on a queue; a listener thread does the
+    file/stdout writes so they stay off the sync path. Later calls return
+    the existing listener rather than adding handlers or opening the log
+    file again.
+    
+    Args:
+        daemon_mode: Log to the file only, not stdout
+        
+    Returns:
+        The QueueListener writing the records
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return _log_listener
+        
+    LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+    handlers = [SharedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)]
+    if not daemon_mode:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        
+    # SimpleQueue.put is reentrant, so the signal handlers can log safely
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _log_listener.start()
+    atexit.register(stop_logging)  # Flush whatever is still queued
+    
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    logging.getLogger('watchfiles').setLevel(logging.WARNING)  # Logs every change batch at INFO
+    return _log_listener
+    
+def stop_logging():
+    """Stop the log listener thread, writing out any queued records."""
+    if _log_listener and _log_listener._thread:
+        _log_listener.stop()
+
+def pygit2_credentials(url, username_from_url, allowed_types):
+    """Authenticate libgit2 SSH connections through ssh-agent, as the git command line would."""
+    if allowed_types & pygit2.enums.CredentialType.SSH_KEY:
+        return pygit2.KeypairFromAgent(username_from_url)
+    raise pygit2.Passthrough  # Let libgit2 fail so we fall back to git
+
+_fetch_coordinators = {}  # repo working dir -> FetchCoordinator
+_fetch_coordinators_lock = threading.Lock()
+
+def get_fetch_coordinator(repo):
+    """Return the shared FetchCoordinator for a repository."""
+    with _fetch_coordinators_lock:
+        if repo.working_dir not in _fetch_coordinators:
+            _fetch_coordinators[repo.working_dir] = FetchCoordinator(repo)
+        return _fetch_coordinators[repo.working_dir]
+
+class TrackedBranch:
+    """A local branch kept fast-forwarded to its remote-tracking branch."""
+    def __init__(self, repo, name):
+        self.repo = repo
+        self.name = name
+        
+        # The branch and its tracking branch don't change while we run, so
+        # look them up once instead of on every check
+        self.head = repo.heads[name]
+        self.tracking = self.head.tracking_branch()
+        if self.tracking:
+            self.remote_name = self.tracking.remote_head
+            self.refspec = f'+refs/heads/{self.remote_name}:refs/remotes/origin/{self.remote_name}'
+            self.revspec = f'{name}..{self.tracking.name}'  # Commits we're behind by
+            # A non-forced refspec for updating the branch without a checkout,
+            # which only allows fast-forwards
+            self.update_refspec = f'{self.tracking.path}:{self.head.path}'
+        self.checked_shas = None  # (local, remote) tips the last check found nothing to do for
 
 class GitBranchSyncer:
-    def __init__(self, repo_path=None, branch_name=None, daemon_mode=False):
+    """
+    Keeps the branches of one repository in sync with origin.
+    
+    In daemon mode there is a single syncer per working tree. It listens on
+    branch-syncer.sock in the working tree's git directory (.git, or
+    .git/worktrees/<name> for a linked worktree) so later invocations can add
+    or remove branches. A daemon per working tree means a branch is always
+    fast-forwarded by the daemon of the tree that has it checked out, since
+    git refuses to move a branch checked out in another worktree.
+    Every syncer lists itself in the registry file for `list`/`stop`.
+    
+    A foreground daemon behaves the same but doesn't fork, for running under
+    a service manager such as systemd.
+    """
+    def __init__(self, repo_path=None, branch_name=None, daemon_mode=False, repo=None, foreground=False,
+                 min_interval=MIN_CHECK_INTERVAL, max_interval=MAX_CHECK_INTERVAL):
         self.repo_path = repo_path or Path.cwd()
         self.branch_name = branch_name
         self.daemon_mode = daemon_mode
+        self.foreground = foreground
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
         self.running = True
+        self.branches = {}  # branch name -> TrackedBranch
+        self.command_server = None
+        self.registered = False
+        self.started_at = None
+        self._command_lock = threading.Lock()  # Held while answering a request
         self.current_hooks_process = None
         self.log_file = None
+        self.log_listener = None
+        self._stop_event = threading.Event()  # Stops the file watcher
+        # Self-pipe the polling loop waits on. Signal handlers only write to it
+        # (and set plain attributes): touching a threading.Event from a handler
+        # can deadlock on the lock the interrupted main thread already holds.
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._stop_signal = None
+        self._interval = self.min_interval
+        self._empty_streak = 0
+        # Polling loop, file watcher and command server share the repo and branches
+        self._sync_lock = threading.RLock()
+        self._watch_thread = None
         
-        # Set up logging
-        self.setup_logging()
+        # Set up logging (shared by every syncer in the process)
+        self.log_listener = configure_logging(self.daemon_mode)
+        self.log_file = LOG_FILE
+        self.logger = logging.getLogger('GitBranchSyncer')
         
-        # Get repository
+        # Get repository (unless the caller already opened it)
         try:
-            self.repo = git.Repo(self.repo_path, search_parent_directories=True)
+            self.repo = repo if repo is not None else get_repo(str(self.repo_path))
             self.repo_path = Path(self.repo.working_dir)
+            self.git_dir = Path(self.repo.common_dir).resolve()  # Shared refs (all worktrees)
+            self.worktree_git_dir = Path(self.repo.git_dir).resolve()  # Holds our command socket
         except git.InvalidGitRepositoryError:
-            self.logger.error("Error: Not in a git repository")
-            sys.exit(1)
+            self.fail("Error: Not in a git repository")
             
         # Get branch name if not specified
         if not self.branch_name:
             self.branch_name = self.repo.active_branch.name
             
-        # Set branch name in environment for process tracking
-        os.environ['BRANCH_NAME'] = self.branch_name
+        try:
+            self.add_branch(self.branch_name)
+        except ValueError as e:
+            self.fail(str(e))
+            
+        self.configure_repo()
+        self.fetch_coordinator = get_fetch_coordinator(self.repo)
         
-    def setup_logging(self):
-        """Set up logging configuration."""
-        log_dir = Path.home() / ".gitbranchsyncer" / "logs"
-        log_dir.mkdir(parents=True, exist_ok=True)
-        self.log_file = log_dir / "gitbranchsyncer.log"
+    def fail(self, message):
+        """Log a startup error and exit, telling the terminal too when the log doesn't go there."""
+        self.logger.error(message)
+        if self.daemon_mode:  # Only the log file is written to
+            print(message)
+        sys.exit(1)
         
-        handlers = [logging.FileHandler(self.log_file)]
-        if not self.daemon_mode:
-            handlers.append(logging.StreamHandler(sys.stdout))
+    def add_branch(self, branch_name):
+        """
+        Start syncing a branch.
+        
+        Raises:
+            ValueError: If the branch doesn't exist or isn't tracking a remote branch
+        """
+        try:
+            tracked = TrackedBranch(self.repo, branch_name)
+        except IndexError:
+            raise ValueError(f"Error: Branch '{branch_name}' not found")
+        if not tracked.tracking:
+            raise ValueError(f"Branch '{branch_name}' is not tracking a remote branch")
             
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s [%(levelname)s] %(message)s',
-            handlers=handlers
-        )
-        self.logger = logging.getLogger('GitBranchSyncer')
+        with self._sync_lock:
+            self.branches[branch_name] = tracked
+            self.update_registry_entry()
+        self.logger.info(f"Monitoring branch: {branch_name}")
+        
+    def remove_branch(self, branch_name):
+        """
+        Stop syncing a branch, shutting down once no branches are left.
+        
+        Returns:
+            False if the branch wasn't being synced (e.g. already dropped after an error)
+        """
+        with self._sync_lock:
+            if self.branches.pop(branch_name, None) is None:
+                return False
+            self.update_registry_entry()
+            if not self.branches:
+                self.logger.info("No branches left to monitor, shutting down")
+                self.running = False
+                self.notify_loop()
+            return True
+                
+    def register(self):
+        """Add ourselves to the registry, removing the entry again at exit."""
+        self.registered = True
+        with self._sync_lock:
+            self.update_registry_entry()
+        atexit.register(self.unregister)
+        
+    def update_registry_entry(self):
+        """Write our current branches to the registry (once registered)."""
+        if not self.registered:
+            return
+        pid = os.getpid()
+        entry = {
+            'pid': pid,
+            'repo_path': str(self.repo_path.resolve()),
+            'branches': list(self.branches),
+            'started_at': self.started_at,
+        }
+        update_registry(lambda entries: [e for e in entries if e['pid'] != pid] + [entry])
+        
+    def unregister(self):
+        """Remove our registry entry."""
+        if not self.registered:
+            return
+        self.registered = False
+        pid = os.getpid()
+        update_registry(lambda entries: [e for e in entries if e['pid'] != pid])
+        
+    def listen_for_commands(self):
+        """
+        Bind the command socket for add/remove commands from other invocations.
+        
+        Called before daemonizing, so a start racing ours finds this daemon
+        instead of failing after its parent has already exited.
+        
+        Returns:
+            False if another daemon for the working tree is already listening
+        """
+        socket_path = self.worktree_git_dir / SOCKET_FILE_NAME
+        with open(self.worktree_git_dir / SOCKET_LOCK_NAME, 'a') as lock:
+            # Bind and listen under the lock, so a socket that refuses
+            # connections while we hold it really was left behind by a dead daemon
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Only our user may add/remove branches. Set the mode through the umask
+            # so the socket is never connectable by others, even briefly (the
+            # daemon runs with umask 0).
+            old_umask = os.umask(0o177)
+            try:
+                try:
+                    server.bind(str(socket_path))
+                except OSError as e:
+                    if e.errno != errno.EADDRINUSE:
+                        raise
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                        try:
+                            probe.connect(str(socket_path))
+                        except ConnectionRefusedError:
+                            pass  # Stale, so take it over
+                        else:
+                            server.close()
+                            return False
+                    socket_path.unlink()
+                    server.bind(str(socket_path))
+                server.listen()
+            except OSError as e:
+                server.close()
+                self.logger.error(f"Could not listen on {socket_path}: {e}")
+                print(f"Error: Could not listen on {socket_path}: {e}")
+                sys.exit(1)
+            finally:
+                os.umask(old_umask)
+                
+        self.command_server = server
+        return True
+        
+    def start_command_server(self):
+        """Answer commands on the socket bound by listen_for_commands."""
+        threading.Thread(target=self._serve_commands, daemon=True).start()
+        
+    def _serve_commands(self):
+        """Answer one JSON request per connection until the daemon exits."""
+        while self.running:
+            try:
+                conn, _ = self.command_server.accept()
+            except OSError:
+                return  # Server closed on shutdown
+            with conn:
+                # Read before taking the lock, so a client that never sends
+                # anything can't hold up other commands or shutdown
+                conn.settimeout(COMMAND_TIMEOUT)
+                try:
+                    request = json.loads(conn.makefile().readline())
+                except OSError:
+                    continue  # Timed out or went away without sending a request
+                except ValueError as e:
+                    self.send_reply(conn, {'ok': False, 'message': f"Invalid request: {e}"})
+                    continue
+                    
+                with self._command_lock:
+                    try:
+                        reply = self.handle_command(request)
+                    except (KeyError, TypeError) as e:
+                        reply = {'ok': False, 'message': f"Invalid request: {e}"}
+                    self.send_reply(conn, reply)
+                    
+    def send_reply(self, conn, reply):
+        """Send a reply dict to a command client."""
+        try:
+            conn.sendall((json.dumps(reply) + "\n").encode())
+        except OSError:
+            pass  # Client went away
+            
+    def handle_command(self, request):
+        """Handle a request from send_command, returning the reply dict."""
+        command, branch_name = request['command'], request['branch']
+        label = f"'{self.repo_path.name}/{branch_name}'"
+        
+        if command == 'add':
+            with self._sync_lock:
+                if branch_name in self.branches:
+                    return {'ok': False, 'message': f"Already monitoring {label} (PID: {os.getpid()})",
+                            'already_monitoring': True}
+                try:
+                    self.add_branch(branch_name)
+                except ValueError as e:
+                    return {'ok': False, 'message': str(e)}
+            self.wake()  # Check the new branch right away
+            return {'ok': True, 'message': f"Added {label} to daemon (PID: {os.getpid()})"}
+            
+        if command == 'remove':
+            # Checked and removed under one lock, since a sync error can drop the branch too
+            if not self.remove_branch(branch_name):
+                return {'ok': False, 'message': f"Not monitoring {label}"}
+            self.logger.info(f"Stopped monitoring branch: {branch_name}")
+            if self.running:
+                return {'ok': True, 'message': f"Stopped monitoring {label} (PID: {os.getpid()})"}
+            return {'ok': True, 'message': f"Stopped daemon for {label} (PID: {os.getpid()})",
+                    'exiting_pid': os.getpid()}
+            
+        return {'ok': False, 'message': f"Unknown command: {command}"}
+        
+    def cleanup_daemon_files(self):
+        """Remove the command socket on shutdown."""
+        if not self.command_server:
+            return
+        with self._command_lock:  # Let an in-flight reply (e.g. to our last `remove`) go out
+            # Unlink before closing, so we can't remove the socket of a daemon
+            # that takes over once ours stops answering
+            try:
+                (self.worktree_git_dir / SOCKET_FILE_NAME).unlink()
+            except FileNotFoundError:
+                pass
+            self.command_server.close()
+                
+    def configure_repo(self):
+        """Enable git's commit-graph/fsmonitor speedups unless already configured."""
+        settings = dict(REPO_PERFORMANCE_CONFIG)
+        if sys.platform in ('darwin', 'win32'):  # The builtin fsmonitor daemon doesn't exist on Linux
+            settings['core.fsmonitor'] = 'true'
+            
+        try:
+            for key, value in settings.items():
+                try:
+                    self.repo.git.config('--get', key)
+                except git.GitCommandError:
+                    # Unset, so opt in
+                    self.repo.git.config('--local', key, value)
+                    self.logger.info(f"Set {key}={value} in repository config")
+        except git.GitCommandError as e:
+            self.logger.warning(f"Could not update repository config: {e}")
+            
+    def write_commit_graph(self):
+        """Update the commit-graph in a background thread."""
+        def write():
+            try:
+                self.repo.git.commit_graph('write', '--reachable', '--split')
+            except git.GitCommandError as e:
+                self.logger.warning(f"Could not write commit-graph: {e}")
+                
+        threading.Thread(target=write, daemon=True).start()
         
     def daemonize(self):
         """Daemonize the process."""
+        # The listener thread won't survive the fork, so flush it now and
+        # start a new one in the daemon
+        stop_logging()
+        
         # First fork (detaches from parent)
         try:
             pid = os.fork()
@@ -83,6 +680,8 @@ class GitBranchSyncer:
         sys.stdout.flush()
         sys.stderr.flush()
         
+        self.log_listener.start()
+        
         pid = os.getpid()
         self.logger.info(f"Daemon started with PID {pid}")
         self.logger.info(f"Logs available at: {self.log_file}")
@@ -129,168 +728,601 @@ class GitBranchSyncer:
             self.logger.error(f"Error executing hooks script: {e}")
             return False
 
-    def check_and_sync_branch(self):
-        """Check for and sync new commits for the branch."""
+    def check_and_sync_branches(self, fetch=True):
+        """
+        Check for and sync new commits for every monitored branch.
+        
+        Args:
+            fetch: Fetch from origin first. The file watcher passes False since it
+                only fires once the remote-tracking refs have already been updated.
+                
+        Returns:
+            True if any branch was updated
+        """
+        with self._sync_lock:
+            branches = list(self.branches.values())
+            if fetch:
+                # Queue every fetch before waiting so they share one `git fetch`
+                fetches = {self.fetch_coordinator.fetch(tracked.remote_name, tracked.refspec): tracked
+                           for tracked in branches}
+                
+        if fetch:
+            # Sync in completion order: branches the remote hasn't moved are
+            # released before the fetch starts, so their rev-list overlaps it.
+            # Wait without the lock so add/remove commands aren't held up by the network.
+            ready = ((fetches[fetched], fetched) for fetched in as_completed(fetches))
+        else:
+            ready = ((tracked, None) for tracked in branches)
+            
+        synced = False
+        for tracked, fetched in ready:
+            with self._sync_lock:
+                if self.branches.get(tracked.name) is not tracked:
+                    continue  # Removed while we waited
+                if self.sync_branch(tracked, fetched):
+                    synced = True
+        return synced
+            
+    def is_checked_out(self, tracked):
+        """Check whether the branch is the one checked out in the working tree."""
         try:
-            # Fetch latest changes
-            self.repo.remotes.origin.fetch()
+            return self.repo.active_branch.name == tracked.name
+        except TypeError:  # Detached HEAD
+            return False
             
-            # Get the branch
-            branch = self.repo.heads[self.branch_name]
+    def sync_branch(self, tracked, fetched=None):
+        """
+        Fast-forward one branch to its remote-tracking branch.
+        
+        Errors stop monitoring the branch (and the syncer, once no branches are left).
+        
+        Args:
+            tracked: The TrackedBranch to sync
+            fetched: Future for the branch's queued fetch, if one was started
             
-            # Get tracking branch
-            tracking_branch = branch.tracking_branch()
-            if not tracking_branch:
-                self.logger.error(f"Branch '{self.branch_name}' is not tracking a remote branch")
-                self.running = False
+        Returns:
+            True if new commits were pulled
+        """
+        try:
+            if fetched:
+                fetched.result()
+                
+            # Neither tip has moved since the last check found nothing to do
+            # (the usual case), so skip the revision walk
+            shas = (ref_sha(self.repo, tracked.head.path), ref_sha(self.repo, tracked.tracking.path))
+            if shas == tracked.checked_shas:
                 return False
-            
-            # Check if we need to pull
-            commits_behind = list(self.repo.iter_commits(f'{self.branch_name}..{tracking_branch.name}'))
-            if not commits_behind:
+                
+            # Check if we need to pull (count only, don't build a Commit object per commit)
+            commits_behind = int(self.repo.git.rev_list('--count', tracked.revspec))
+            if commits_behind == 0:
+                tracked.checked_shas = shas
                 return False
             
             # Pull changes
             timestamp = datetime.now().strftime("%H:%M:%S")
-            self.logger.info(f"Found {len(commits_behind)} new commit(s). Pulling changes...")
-            self.repo.git.pull('--ff-only')  # Only fast-forward pulls to avoid conflicts
+            self.logger.info(f"Found {commits_behind} new commit(s) on '{tracked.name}'. Pulling changes...")
+            checked_out = self.is_checked_out(tracked)
+            if checked_out:
+                # The fetch already updated the tracking branch, so merge it rather
+                # than `pull`, which would fetch again. Fast-forward only to avoid conflicts.
+                self.repo.git.merge('--ff-only', tracked.tracking.name)
+            else:
+                # Nothing to update in the working tree, so just move the branch
+                self.repo.git.fetch('.', tracked.update_refspec)
             self.logger.info("Successfully synced with remote!")
             
-            # Execute hooks after successful pull
-            self.execute_hooks()
+            # Keep generation numbers current for the next revision walk
+            self.write_commit_graph()
+            
+            # Execute hooks after successful pull (only the working tree is rebuilt)
+            if checked_out:
+                self.execute_hooks()
             return True
             
         except git.GitCommandError as e:
             self.logger.error(f"Git error occurred: {e}")
-            self.logger.info("Shutting down daemon due to git error")
-            self.running = False
-            return False
-        except KeyError:
-            self.logger.error(f"Error: Branch '{self.branch_name}' not found")
-            self.logger.info("Shutting down daemon due to missing branch")
-            self.running = False
-            return False
+            reason = "git error"
+        except RemoteBranchNotFound:
+            self.logger.error(f"Error: Branch '{tracked.tracking.name}' no longer exists on the remote")
+            reason = "missing branch"
+        except (KeyError, IndexError):
+            self.logger.error(f"Error: Branch '{tracked.name}' not found")
+            reason = "missing branch"
         except Exception as e:
             self.logger.error(f"An error occurred: {e}")
-            self.logger.info("Shutting down daemon due to error")
-            self.running = False
-            return False
+            reason = "error"
+            
+        self.logger.info(f"Stopped monitoring '{tracked.name}' due to {reason}")
+        self.remove_branch(tracked.name)
+        return False
+        
+    def start_file_watcher(self):
+        """Start watching the remote-tracking refs in a background thread."""
+        if watchfiles is None:
+            self.logger.info("watchfiles not installed, relying on polling only")
+            return
+        if is_network_filesystem(self.git_dir):
+            self.logger.info("Repository is on a network filesystem, relying on polling only")
+            return
+        self._watch_thread = threading.Thread(target=self._file_watch_loop, daemon=True)
+        self._watch_thread.start()
+        
+    def _file_watch_loop(self):
+        """Sync as soon as a watched refs/remotes/origin/<branch> or packed-refs changes."""
+        refs_dir = self.git_dir / "refs" / "remotes" / "origin"
+        packed_refs = self.git_dir / "packed-refs"
+        
+        def ref_filter(change, path):
+            if path == str(packed_refs):
+                return True
+            # Branches can be added and removed while we watch
+            with self._sync_lock:
+                return any(path == str(refs_dir / tracked.remote_name)
+                           for tracked in self.branches.values())
+        
+        while self.running:
+            paths = [path for path in (refs_dir, packed_refs) if path.exists()]
+            if not paths:
+                self.logger.info("No remote-tracking refs to watch, relying on polling only")
+                return
+            packed_refs_inode = get_inode(packed_refs)
+            
+            try:
+                for _ in watchfiles.watch(*paths, watch_filter=ref_filter, stop_event=self._stop_event,
+                               raise_interrupt=False):
+                    if self.check_and_sync_branches(fetch=False):
+                        self.wake()  # Activity, so go back to frequent fetches
+                    if not self.running:
+                        self.notify_loop()  # Wake the polling loop so it exits too
+                        return
+                    if get_inode(packed_refs) != packed_refs_inode:
+                        # Git rewrites packed-refs via rename, which leaves us
+                        # watching a stale inode, so re-establish the watch
+                        break
+            except Exception as e:
+                self.logger.warning(f"File watcher stopped ({e}), relying on polling only")
+                return
             
     def signal_handler(self, signum, frame):
-        """Handle signals for graceful shutdown."""
+        """Handle signals for graceful shutdown (run() does the cleanup once the loop wakes)."""
+        self._stop_signal = signum
         self.running = False
-        self.terminate_hooks()
-        self.logger.info("Shutting down Git Branch Syncer...")
+        self.notify_loop()
         
+    def wake(self, signum=None, frame=None):
+        """Return to the shortest check interval and check right away (also the SIGUSR1/SIGHUP handler)."""
+        self._interval = self.min_interval
+        self._empty_streak = 0
+        self.notify_loop()
+        
+    def notify_loop(self):
+        """Wake the polling loop. Only writes to the self-pipe, so it's safe in signal handlers."""
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass  # Pipe full, so a wakeup is already pending
+            
+    def wait_for_wakeup(self, timeout):
+        """Sleep until notify_loop is called or timeout seconds pass."""
+        select.select([self._wake_read], [], [], timeout)
+        try:
+            while os.read(self._wake_read, 512):
+                pass
+        except BlockingIOError:
+            pass  # Drained
+        
+    def back_off(self):
+        """Double the check interval after every IDLE_CHECKS_PER_BACKOFF empty checks."""
+        self._empty_streak += 1
+        if self._empty_streak % IDLE_CHECKS_PER_BACKOFF == 0 and self._interval < self.max_interval:
+            self._interval = min(self._interval * 2, self.max_interval)
+            self.logger.info(f"No new commits recently, checking every {self._interval:g} seconds")
+            
     def run(self):
-        """Main loop to monitor branch."""
+        """Main loop to monitor branches."""
         if self.daemon_mode:
-            self.daemonize()
+            if not self.foreground:
+                self.daemonize()
+            self.start_command_server()
         else:
             pid = os.getpid()
             print(f"Git Branch Syncer started for branch: {self.branch_name}")
             print(f"PID: {pid}")
+            
+        # After daemonizing, so the entry has the daemon's PID
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.register()
 
         # Set up signal handlers
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGUSR1, self.wake)
+        # A daemon has no terminal to lose, so SIGHUP is free to mean "check now".
+        # In the foreground it still means the terminal went away.
+        signal.signal(signal.SIGHUP, self.wake if self.daemon_mode else self.signal_handler)
         
         self.logger.info(f"Starting Git Branch Syncer for branch: {self.branch_name}")
         
-        check_interval = 5  # seconds between checks
+        # Picks up fetches made outside the syncer (IDE, manual `git fetch`) immediately
+        self.start_file_watcher()
         
-        while self.running:
-            self.check_and_sync_branch()
-            if not self.running:  # Check if we should exit due to error
-                break
-            time.sleep(check_interval)
+        try:
+            while self.running:
+                if self.check_and_sync_branches():
+                    self._interval = self.min_interval
+                    self._empty_streak = 0
+                else:
+                    self.back_off()
+                if not self.running:  # Check if we should exit due to error
+                    break
+                self.wait_for_wakeup(self._interval)
+        finally:
+            self._stop_event.set()
+            if self._stop_signal is not None:
+                self.terminate_hooks()
+                self.logger.info("Shutting down Git Branch Syncer...")
+            if self._watch_thread:
+                self._watch_thread.join(timeout=5)
+            self.cleanup_daemon_files()
+            stop_logging()
 
-def get_running_daemons(exclude_pid=None):
+def ref_sha(repo, ref_path):
+    """
+    Read the sha a ref points at from the loose ref or packed-refs file.
+    
+    Unlike Reference.commit this doesn't build a Commit object or ask git's
+    object database about it, so it's cheap enough for every check.
+    
+    Returns:
+        The hex sha, or None if the ref doesn't exist
+    """
+    try:
+        return git.SymbolicReference.dereference_recursive(repo, ref_path)
+    except ValueError:
+        return None
+
+def get_inode(path):
+    """Return the inode of path, or None if it doesn't exist."""
+    try:
+        return path.stat().st_ino
+    except FileNotFoundError:
+        return None
+
+def is_network_filesystem(path):
+    """Check whether path is on a network filesystem (Linux only, via /proc/mounts)."""
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    
+    # Longest mount point containing the path wins
+    path = str(Path(path).resolve())
+    best_mount, fs_type = '', None
+    for mount_point, mount_fs_type in mounts:
+        if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+            if len(mount_point) >= len(best_mount):
+                best_mount, fs_type = mount_point, mount_fs_type
+    return fs_type in NETWORK_FILESYSTEMS
+
+def send_command(git_dir, command, branch_name):
     """
-    Get list of all running daemons using pgrep.
+    Send a command to the daemon for a working tree.
     
     Args:
-        exclude_pid: Optional PID to exclude from results (e.g., current process)
+        git_dir: The working tree's git directory (repo.git_dir, which is
+            .git/worktrees/<name> for a linked worktree)
+        command: 'add' or 'remove'
+        branch_name: Branch the command applies to
+        
+    Returns:
+        The daemon's reply dict, or None if no daemon is running for the working tree
     """
-    running_daemons = []
+    socket_path = Path(git_dir) / SOCKET_FILE_NAME
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        # A daemon that stops answering mustn't hang the CLI
+        client.settimeout(COMMAND_REPLY_TIMEOUT)
+        try:
+            client.connect(str(socket_path))
+        except FileNotFoundError:
+            return None
+        except ConnectionRefusedError:
+            # Left behind by a daemon that was killed (the next daemon replaces it),
+            # or one that has bound but not started listening yet
+            return None
+        except socket.timeout:
+            print(f"Error: The daemon at {socket_path} is not accepting commands")
+            sys.exit(1)
+        try:
+            client.sendall((json.dumps({'command': command, 'branch': branch_name}) + "\n").encode())
+            reply = client.makefile().readline()
+        except socket.timeout:
+            print(f"Error: No reply from the daemon within {COMMAND_REPLY_TIMEOUT} seconds")
+            sys.exit(1)
+    return json.loads(reply) if reply else None
+
+def update_registry(update):
+    """
+    Rewrite the registry under an exclusive lock.
     
+    Args:
+        update: Function taking the list of registry entries and returning the new list
+    """
+    REGISTRY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(REGISTRY_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    with open(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)  # Released when the file is closed
+        try:
+            entries = json.load(f)
+        except ValueError:
+            entries = []  # New (empty) file
+        entries = update(entries)
+        f.seek(0)
+        f.truncate()
+        json.dump(entries, f, indent=2)
+
+def read_registry():
+    """Return the registry entries (which may include syncers that have died)."""
     try:
-        # Run pgrep to find all git-branch-syncer processes
-        import subprocess
-        result = subprocess.run(['pgrep', '-fl', 'git-branch-sync'], 
-                              capture_output=True, text=True)
-        
-        if result.returncode != 0 and result.returncode != 1:  # 1 means no processes found
-            return running_daemons
-            
-        # Parse each process
-        for line in result.stdout.splitlines():
-            try:
-                # Split line into PID and command
-                pid, *cmd_parts = line.strip().split()
-                pid = int(pid)
-                
-                # Skip excluded process
-                if exclude_pid is not None and pid == exclude_pid:
-                    continue
-                
-                # Read process environment
-                try:
-                    with open(f'/proc/{pid}/environ', 'rb') as f:
-                        env = f.read().decode('utf-8', errors='ignore')
-                except (FileNotFoundError, PermissionError):
-                    # Process might have died or we don't have permission
-                    continue
-                
-                # Find PWD in environment
-                repo_path = None
-                branch_name = None
-                for var in env.split('\0'):
-                    if var.startswith('PWD='):
-                        repo_path = Path(var[4:])
-                    elif var.startswith('BRANCH_NAME='):
-                        branch_name = var[12:]
-                
-                if not branch_name:
-                    # Try to get branch name from git if not in environment
-                    try:
-                        repo = git.Repo(repo_path, search_parent_directories=True)
-                        branch_name = repo.active_branch.name
-                    except (git.InvalidGitRepositoryError, AttributeError):
-                        branch_name = "unknown"
-                
-                if repo_path:
-                    running_daemons.append((repo_path, branch_name, pid))
-                else:
-                    # Include PID even if we couldn't get the repo path
-                    running_daemons.append((Path("unknown"), "unknown", pid))
-                    
-            except (ValueError, IndexError):
-                continue
-                
+        with open(REGISTRY_FILE) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def is_process_alive(pid):
+    """
+    Check whether a process exists and is a syncer.
+    
+    On Linux the command line is checked too, so a PID reused by another
+    program after a syncer was killed doesn't count.
+    """
+    try:
+        cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
     except FileNotFoundError:
-        # pgrep not available
-        print("Warning: pgrep command not found")
+        if Path("/proc/self").exists():
+            return False  # No such process
+    except OSError:
+        pass  # Zombie or no /proc access; fall back to kill
+    else:
+        return b'git-branch-syncer' in cmdline or b'gitbranchsyncer' in cmdline
+        
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, but belongs to someone else
+    return True
+
+@functools.lru_cache(maxsize=None)
+def get_repo(path):
+    """
+    Open the repository containing path, once per process.
+    
+    git.Repo reads the config and probes the .git directory, so callers share
+    one instance instead of constructing their own.
+    
+    Raises:
+        git.InvalidGitRepositoryError: If path isn't inside a repository
+    """
+    return git.Repo(path, search_parent_directories=True)
+
+def find_worktree(start):
+    """
+    Find the working tree containing start with one lstat per directory.
+    
+    A `.git` directory or file (worktrees, submodules) marks the root.
+    
+    Returns:
+        The working tree root, or None if start isn't inside one
+    """
+    start = Path(start).resolve()
+    for directory in (start, *start.parents):
+        try:
+            os.lstat(directory / ".git")
+            return directory
+        except FileNotFoundError:
+            continue
+    return None
+
+def open_repo():
+    """Open the repository containing the current directory, exiting if there isn't one."""
+    worktree = find_worktree(Path.cwd())
+    if worktree is None:
+        print("Error: Not in a git repository")
+        sys.exit(1)
+    try:
+        return get_repo(str(worktree))
+    except git.InvalidGitRepositoryError:
+        print("Error: Not in a git repository")
+        sys.exit(1)
+
+def start_daemon(branch_name=None, foreground=False, **intervals):
+    """
+    Add a branch to the working tree's daemon, starting the daemon if needed.
+    
+    Args:
+        branch_name: Branch to monitor (defaults to the current branch)
+        foreground: Run a new daemon in this process instead of forking
+        intervals: min_interval/max_interval for a new daemon (a running
+            daemon keeps its own)
+    """
+    repo = open_repo()
+    branch_name = branch_name or repo.active_branch.name
+    
+    reply = send_command(repo.git_dir, 'add', branch_name)
+    if reply is None:
+        syncer = GitBranchSyncer(repo=repo, branch_name=branch_name, daemon_mode=True, foreground=foreground,
+                                 **intervals)
+        if syncer.listen_for_commands():
+            syncer.run()
+            return
+        # Another invocation started the daemon since we checked, so hand it the branch
+        reply = send_command(repo.git_dir, 'add', branch_name)
+        if reply is None:
+            print("Error: The daemon for this working tree exited while starting")
+            sys.exit(1)
+    print(reply['message'])
+    # Under a service manager an already monitored branch isn't a failure,
+    # or Restart=on-failure would keep restarting us
+    if not reply['ok'] and not (foreground and reply.get('already_monitoring')):
+        sys.exit(1)
+
+def get_running_daemons(exclude_pid=None):
+    """
+    Get list of all running daemons from the registry.
+    
+    Args:
+        exclude_pid: Optional PID to exclude from results (e.g., current process)
         
+    Returns:
+        List of (repo_path, branch_name, pid), one per monitored branch
+    """
+    running_daemons = []
+    stale = set()
+    for entry in read_registry():
+        pid = entry['pid']
+        if pid == exclude_pid:
+            continue
+        if not is_process_alive(pid):
+            stale.add((pid, entry['started_at']))  # Killed before it could unregister
+            continue
+        for branch_name in entry['branches']:
+            running_daemons.append((Path(entry['repo_path']), branch_name, pid))
+            
+    if stale:
+        # One rewrite for all of them. Match on start time too, in case the PID
+        # was reused by a syncer that registered since we read the file.
+        update_registry(lambda entries: [entry for entry in entries
+                                         if (entry['pid'], entry['started_at']) not in stale])
     return running_daemons
 
+@functools.lru_cache(maxsize=1)
+def get_running_daemons_map():
+    """
+    Get the running daemons other than this process, keyed for lookup.
+    
+    Read once per CLI invocation; stop_daemon clears the cache. A branch
+    monitored by two processes maps to only one of them, so use
+    get_running_daemons to act on every process.
+    
+    Returns:
+        Dict of {(repo_path, branch_name): pid}
+    """
+    return {(repo_path, branch_name): pid
+            for repo_path, branch_name, pid in get_running_daemons(exclude_pid=os.getpid())}
+            
 def check_daemon_running(repo_path, branch_name):
     """Check if a daemon is already running for the given branch."""
-    daemons = get_running_daemons(exclude_pid=os.getpid())
-    repo_path = Path(repo_path).resolve()
+    return (Path(repo_path).resolve(), branch_name) in get_running_daemons_map()
+
+def open_pidfds(pids):
+    """
+    Open a pidfd for each process, so we can wait on them without the PIDs being reused.
     
-    for daemon_repo, daemon_branch, _ in daemons:
-        if daemon_repo == repo_path and daemon_branch == branch_name:
-            return True
-    return False
+    Returns:
+        Dict of {pid: fd} for the processes still running, or None if pidfds
+        aren't supported (Linux 5.3+, Python 3.9+)
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    pidfds = {}
+    for pid in pids:
+        try:
+            pidfds[pid] = os.pidfd_open(pid)
+        except ProcessLookupError:
+            pass  # Already gone
+        except OSError:
+            for fd in pidfds.values():
+                os.close(fd)
+            return None  # Kernel older than 5.3
+    return pidfds
+
+def wait_for_exits(pids, timeout=DAEMON_STOP_TIMEOUT, pidfds=None):
+    """
+    Block until the processes exit, sleeping in the kernel rather than polling.
+    
+    Waits on all of them at once, so the total wait is at most one timeout.
+    Uses pidfds on Linux and kqueue on macOS/BSD.
+    
+    Args:
+        pids: PIDs to wait for
+        timeout: Seconds to wait in total
+        pidfds: Result of open_pidfds(pids), if already opened; these are closed
+        
+    Returns:
+        Set of PIDs still running at the timeout, or None if waiting isn't supported
+    """
+    if pidfds is None:
+        pidfds = open_pidfds(pids)
+    deadline = time.monotonic() + timeout
+    
+    if pidfds is not None:
+        try:
+            poller = select.poll()
+            for fd in pidfds.values():
+                poller.register(fd, select.POLLIN)
+            running = {fd: pid for pid, fd in pidfds.items()}
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for fd, _ in poller.poll(remaining * 1000):
+                    poller.unregister(fd)
+                    del running[fd]
+            return set(running.values())
+        finally:
+            for fd in pidfds.values():
+                os.close(fd)
+                
+    if hasattr(select, 'kqueue'):
+        kq = select.kqueue()
+        try:
+            running = set()
+            for pid in pids:
+                event = select.kevent(pid, filter=select.KQ_FILTER_PROC,
+                                      flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                                      fflags=select.KQ_NOTE_EXIT)
+                try:
+                    kq.control([event], 0)
+                    running.add(pid)
+                except ProcessLookupError:
+                    pass  # Already gone
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for event in kq.control(None, len(running), remaining):
+                    running.discard(event.ident)
+            return running
+        finally:
+            kq.close()
+            
+    return None
+
+def wait_for_exit(pid, timeout=DAEMON_STOP_TIMEOUT):
+    """
+    Block until a process exits.
+    
+    Returns:
+        True if the process exited, False on timeout, None if waiting isn't supported
+    """
+    running = wait_for_exits([pid], timeout)
+    return None if running is None else not running
 
 def stop_daemon(pid):
-    """Stop a daemon process by PID."""
+    """Stop a daemon process by PID and wait for it to exit."""
     try:
         os.kill(pid, signal.SIGTERM)
-        return True
     except ProcessLookupError:
         return False
+    
+    if wait_for_exit(pid) is False:
+        print(f"Warning: daemon (PID: {pid}) did not exit within {DAEMON_STOP_TIMEOUT} seconds")
+    get_running_daemons_map.cache_clear()
+    return True
 
 def stop_all_daemons():
     """Stop all running daemons."""
@@ -299,10 +1331,35 @@ def stop_all_daemons():
         print("No Git Branch Syncer daemons are running")
         return
         
+    # A daemon can monitor several branches but only needs stopping once
+    branches_by_pid = {}
     for repo_path, branch_name, pid in daemons:
         repo_name = repo_path.name if repo_path != Path("unknown") else "unknown"
-        if stop_daemon(pid):
-            print(f"Stopped daemon for '{repo_name}/{branch_name}' (PID: {pid})")
+        branches_by_pid.setdefault(pid, []).append(f"{repo_name}/{branch_name}")
+        
+    # Signal every daemon before reporting or waiting, so they shut down in parallel
+    pidfds = open_pidfds(branches_by_pid)
+    stopped = []
+    for pid in branches_by_pid:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            continue
+        stopped.append(pid)
+        
+    for pid in stopped:
+        print(f"Stopped daemon for '{', '.join(branches_by_pid[pid])}' (PID: {pid})")
+    still_running = wait_for_exits(stopped, pidfds=pidfds)
+    for pid in still_running or ():
+        print(f"Warning: daemon (PID: {pid}) did not exit within {DAEMON_STOP_TIMEOUT} seconds")
+        
+    if still_running is not None:
+        # Daemons unregister themselves on exit; drop any that couldn't
+        # (already dead, or killed mid-exit) in one rewrite
+        gone = set(branches_by_pid) - still_running
+        update_registry(lambda entries: [entry for entry in entries
+                                         if entry['pid'] not in gone or is_process_alive(entry['pid'])])
+    get_running_daemons_map.cache_clear()
 
 def list_daemons():
     """List all running daemons."""
@@ -319,65 +1376,139 @@ def list_daemons():
     else:
         print("No Git Branch Syncer daemons are running")
 
+def systemd_quote(word):
+    """Quote one word of a systemd command line (spaces, quotes, specifiers, variables)."""
+    escaped = word.replace('\\', '\\\\').replace('"', '\\"').replace('%', '%%').replace('$', '$$')
+    return f'"{escaped}"'
+
+def install_systemd_unit():
+    """Write the systemd user unit template that runs a foreground daemon per working tree."""
+    if not sys.platform.startswith('linux'):
+        print("Error: install is only supported with systemd on Linux")
+        sys.exit(1)
+        
+    script = shutil.which("git-branch-syncer")
+    command = [script] if script else [sys.executable, str(Path(__file__).resolve())]
+    exec_start = " ".join(systemd_quote(word) for word in command + ["--foreground"])
+    unit_dir = Path(os.environ.get("XDG_CONFIG_HOME", Path.home() / ".config")) / "systemd" / "user"
+    unit_dir.mkdir(parents=True, exist_ok=True)
+    unit_file = unit_dir / SYSTEMD_UNIT_TEMPLATE
+    unit_file.write_text(f"""[Unit]
+Description=Git Branch Syncer for %f
+
+[Service]
+WorkingDirectory=%f
+ExecStart={exec_start}
+ExecReload=/bin/kill -HUP $MAINPID
+Restart=on-failure
+RestartSec=30
+
+[Install]
+WantedBy=default.target
+""")
+    print(f"Installed {unit_file}")
+    print("Enable it for a repository (monitoring its current branch) with:")
+    print('  systemctl --user daemon-reload')
+    print('  systemctl --user enable --now "gitbranchsyncer@$(systemd-escape --path /path/to/repo).service"')
+
+def stop_command(args):
+    """Stop monitoring a branch, or stop every daemon with `stop all`."""
+    if args.branch == "all":
+        stop_all_daemons()
+        return
+        
+    repo = open_repo()
+    repo_path = Path(repo.working_dir).resolve()
+    branch_name = args.branch or repo.active_branch.name
+    
+    # Ask the working tree's daemon to drop the branch
+    reply = send_command(repo.git_dir, 'remove', branch_name)
+    if reply and reply['ok']:
+        if 'exiting_pid' in reply:
+            wait_for_exit(reply['exiting_pid'])
+        print(reply['message'])
+        return
+        
+    # Otherwise look for an interactive syncer
+    daemons = get_running_daemons_map()
+    pid = daemons.get((repo_path, branch_name))
+    if pid is not None and stop_daemon(pid):
+        print(f"Stopped daemon for '{repo_path.name}/{branch_name}' (PID: {pid})")
+        return
+        
+    print(f"No daemon is running for branch '{branch_name}'")
+    # Show running daemons
+    if daemons:
+        print("\nOther running daemons:")
+        current_repo = None
+        for (other_repo, other_branch), pid in sorted(daemons.items()):
+            if other_repo != current_repo:
+                repo_name = other_repo.name if other_repo != Path("unknown") else "unknown"
+                print(f"\n{repo_name}:")
+                current_repo = other_repo
+            print(f"  - Branch '{other_branch}' (PID: {pid})")
+        print("\nTo stop all daemons, use: git-branch-syncer stop all")
+        
+def start_command(args):
+    """Monitor a branch interactively, or hand it to the working tree's daemon."""
+    intervals = {'min_interval': args.min_interval, 'max_interval': args.max_interval}
+    if args.daemon or args.foreground:
+        start_daemon(args.branch, foreground=args.foreground, **intervals)
+        return
+    syncer = GitBranchSyncer(repo=open_repo(), branch_name=args.branch, daemon_mode=False, **intervals)
+    syncer.run()
+
+def positive_seconds(value):
+    """argparse type for a check interval."""
+    seconds = float(value)
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"must be more than 0 seconds: {value}")
+    return seconds
+
+def build_parser():
+    """Build the parser for starting a syncer (`git-branch-syncer [--daemon] [branch]`)."""
+    parser = argparse.ArgumentParser(
+        prog="git-branch-syncer",
+        description="Keep local branches fast-forwarded to their remote-tracking branches.",
+        epilog="other commands: stop [all | branch], list, install")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--daemon", action="store_true",
+                      help="run in the background (one daemon per working tree)")
+    mode.add_argument("--foreground", action="store_true",
+                      help="run as the working tree's daemon without forking, for service managers")
+    parser.add_argument("branch", nargs="?", help="branch to monitor (default: the current branch)")
+    parser.add_argument("--min-interval", type=positive_seconds, default=MIN_CHECK_INTERVAL, metavar="SECONDS",
+                        help=f"seconds between checks while branches are active (default: {MIN_CHECK_INTERVAL})")
+    parser.add_argument("--max-interval", type=positive_seconds, default=MAX_CHECK_INTERVAL, metavar="SECONDS",
+                        help=f"longest gap between checks once branches go quiet (default: {MAX_CHECK_INTERVAL})")
+    parser.set_defaults(handler=start_command)
+    return parser
+
+def build_command_parsers():
+    """Build the parsers for the subcommands, keyed by name."""
+    stop = argparse.ArgumentParser(prog="git-branch-syncer stop",
+                                   description="Stop monitoring a branch (the daemon exits once it has none left).")
+    stop.add_argument("branch", nargs="?", help="branch to stop, or 'all' for every daemon (default: the current branch)")
+    stop.set_defaults(handler=stop_command)
+    
+    list_parser = argparse.ArgumentParser(prog="git-branch-syncer list", description="List running daemons.")
+    list_parser.set_defaults(handler=lambda args: list_daemons())
+    
+    install = argparse.ArgumentParser(prog="git-branch-syncer install",
+                                      description="Install the systemd user unit template.")
+    install.set_defaults(handler=lambda args: install_systemd_unit())
+    return {"stop": stop, "list": list_parser, "install": install}
+
 def main():
     """Main entry point for the script."""
-    if len(sys.argv) > 1:
-        command = sys.argv[1]
-        if command == "--daemon":
-            # Daemon mode with optional branch name
-            branch_name = sys.argv[2] if len(sys.argv) > 2 else None
-            syncer = GitBranchSyncer(branch_name=branch_name, daemon_mode=True)
-            syncer.run()
-        elif command == "stop" or command == "list":
-            # Existing stop/list functionality stays the same...
-            if command == "stop":
-                if len(sys.argv) > 2 and sys.argv[2] == "all":
-                    # Stop all daemons
-                    stop_all_daemons()
-                else:
-                    try:
-                        # Stop specific branch daemon
-                        repo = git.Repo(Path.cwd(), search_parent_directories=True)
-                        repo_path = Path(repo.working_dir).resolve()
-                        branch_name = sys.argv[2] if len(sys.argv) > 2 else repo.active_branch.name
-                        
-                        # Find matching daemon
-                        daemons = get_running_daemons(exclude_pid=os.getpid())
-                        found = False
-                        for daemon_repo, daemon_branch, pid in daemons:
-                            if daemon_repo == repo_path and daemon_branch == branch_name:
-                                if stop_daemon(pid):
-                                    print(f"Stopped daemon for '{repo_path.name}/{branch_name}' (PID: {pid})")
-                                    found = True
-                                    break
-                        
-                        if not found:
-                            print(f"No daemon is running for branch '{branch_name}'")
-                            # Show running daemons
-                            if daemons:
-                                print("\nOther running daemons:")
-                                current_repo = None
-                                for other_repo, other_branch, pid in sorted(daemons, key=lambda x: (x[0], x[1])):
-                                    if other_repo != current_repo:
-                                        repo_name = other_repo.name if other_repo != Path("unknown") else "unknown"
-                                        print(f"\n{repo_name}:")
-                                        current_repo = other_repo
-                                    print(f"  - Branch '{other_branch}' (PID: {pid})")
-                                print("\nTo stop all daemons, use: git-branch-syncer stop all")
-                    except git.InvalidGitRepositoryError:
-                        print("Error: Not in a git repository")
-                        sys.exit(1)
-            elif command == "list":
-                # List all running daemons
-                list_daemons()
-        else:
-            # Start monitoring specific branch in interactive mode
-            syncer = GitBranchSyncer(branch_name=command, daemon_mode=False)
-            syncer.run()
+    argv = sys.argv[1:]
+    # Subcommands take the first word; anything else names a branch to monitor
+    commands = build_command_parsers()
+    if argv and argv[0] in commands:
+        args = commands[argv[0]].parse_args(argv[1:])
     else:
-        # Start monitoring current branch in interactive mode
-        syncer = GitBranchSyncer(daemon_mode=False)
-        syncer.run()
+        args = build_parser().parse_args(argv)
+    args.handler(args)
 
 if __name__ == "__main__":
     main()
@@ -8,11 +8,16 @@ setup(
     py_modules=["gitbranchsyncer"],
     install_requires=[
         "gitpython>=3.1.0",
+        "watchfiles>=0.21",
     ],
+    extras_require={
+        # Fetch in-process through libgit2 instead of spawning git
+        "pygit2": ["pygit2>=1.19"],
+    },
     entry_points={
         "console_scripts": [
             "git-branch-syncer=gitbranchsyncer:main",
         ],
     },
-    python_requires=">=3.6",
+    python_requires=">=3.8",
 )